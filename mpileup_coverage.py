@@ -7,6 +7,13 @@
 import argparse
 import os
 import sys
+from array import array
+from bisect import bisect_right
+
+# flags for each base in the BED file, recording its coverage in the mpileup file
+BASE_UNSEEN = 0
+BASE_OK = 1
+BASE_LOW_COVERAGE = 2
 
 def cli_arguments(args):
     """Parses command line arguments.
@@ -34,135 +41,209 @@ def cli_arguments(args):
 def read_bedfile(args):
     """
     This function parses an input sambamba bed file and captures all bases to be assessed for coverage.
-    A dictionary (region_dict) contains a entry for each region, with the value as a further dictionary containing the chromosome, start, stop and description
-    A list (position_list) containing each base in the form of chr:pos used to quickly parse the mpileup file
+    A dictionary (regions) contains parallel sequences of the chromosome, start, stop and description, with one entry for each region
+    A dictionary (bed_intervals) containing the sorted, merged intervals covered by the BED file for each chromosome, as parallel arrays
+    of starts, stops and offsets, used to quickly parse the mpileup file. Alongside these is a bytearray (covered_bases) with one flag
+    per base in the intervals (the interval's offset plus the base's position within the interval), set when parsing the mpileup.
+    Flags are BASE_UNSEEN until the base is found in the mpileup file, then BASE_OK or BASE_LOW_COVERAGE
     Input: 
         command line arguments
 
     Returns:
-        - region_dict (dictionary)
-        - position_list(list) 
+        - regions (dictionary)
+        - bed_intervals (dictionary) 
     """
-    position_list = []
-    region_dict = {}
+    regions = {"chr": [], "start": array("l"), "stop": array("l"), "description": []}
+    # index of each region in regions, used to ensure each genomic coord is only reported once
+    region_index = {}
     with open(args.bedfile,'r') as bedfile:
-        for line in bedfile.readlines():
+        for line in bedfile:
+            # split the line once, removing the trailing newline
+            fields = line.rstrip("\n").split("\t")
             # check it's a sambama file, needed for the amplicon description
-            assert len(line.split("\t")) == 8 , "has sambamba bed file been supplied???"
+            assert len(fields) == 8 , "has sambamba bed file been supplied???"
             # name relevant columns
-            chr, start, stop, combined_genomic_coord, col5, col6, amplicon_description, entrez_geneid = line.split("\t")
-            # create dictionary entry using genomic coord, as this will be unique (amplicon_description may not be)
-            region_dict[combined_genomic_coord] = {"chr":str(chr),"start":int(start),"stop":int(stop), "description":amplicon_description}
-            # add each base to the position_list in form chr:pos
-            for base in range(int(start),int(stop)):
-                position_list.append(chr+":"+str(base))
-    return region_dict,position_list
-
-def parse_mpileup(args,position_list):
+            chr, start, stop, combined_genomic_coord, col5, col6, amplicon_description, entrez_geneid = fields
+            # intern the chromosome so all regions on the same chromosome share a single string
+            chr = sys.intern(chr)
+            # record each region once using genomic coord, as this will be unique (amplicon_description may not be)
+            if combined_genomic_coord in region_index:
+                index = region_index[combined_genomic_coord]
+                regions["chr"][index] = chr
+                regions["start"][index] = int(start)
+                regions["stop"][index] = int(stop)
+                regions["description"][index] = amplicon_description
+            else:
+                region_index[combined_genomic_coord] = len(regions["chr"])
+                regions["chr"].append(chr)
+                regions["start"].append(int(start))
+                regions["stop"].append(int(stop))
+                regions["description"].append(amplicon_description)
+    # merge the regions on each chromosome into sorted, non-overlapping intervals so a single binary search finds any base
+    bed_intervals = {}
+    for chr, start, stop in sorted(zip(regions["chr"], regions["start"], regions["stop"])):
+        if chr not in bed_intervals:
+            bed_intervals[chr] = (array("l"), array("l"), array("l"), bytearray())
+        interval_starts, interval_stops, interval_offsets, covered_bases = bed_intervals[chr]
+        if stop < start:
+            # a backwards region has no bases to assess (see chromosome_coverage) so don't store it as an interval, which
+            # would break the sorted, non-overlapping intervals
+            continue
+        if interval_stops and start <= interval_stops[-1]:
+            # overlaps (or is adjacent to) the previous interval so extend it
+            interval_stops[-1] = max(interval_stops[-1], stop)
+        else:
+            interval_starts.append(start)
+            interval_stops.append(stop)
+    # each interval's bases are stored one after another in covered_bases, starting at the interval's offset
+    for chr, (interval_starts, interval_stops, interval_offsets, covered_bases) in bed_intervals.items():
+        offset = 0
+        for start, stop in zip(interval_starts, interval_stops):
+            interval_offsets.append(offset)
+            offset += stop - start
+        covered_bases.extend(bytes(offset))
+    return regions,bed_intervals
+
+def parse_mpileup(args,bed_intervals):
     """
-    This function parses the input mpilup file and extracts the relevant columns for the bases in the BED file (using position_list)
-    A list (mpileup_list) is generated containing a tupe dictionary for each base, with values (chr, pos, depth)
+    This function streams the input mpilup file and, for each base in the BED file (using bed_intervals), flags in covered_bases
+    whether the read depth meets the minimum required coverage (provided argument).
+    A base is flagged BASE_LOW_COVERAGE if any of its records in the mpileup file are below the required coverage, and BASE_OK
+    otherwise. Bases not included in the mpileup file are left as BASE_UNSEEN (in case the mpileup file was not run with -a)
     Input: 
         - command line arguments
-        - position_list
+        - bed_intervals
 
     Returns:
-        - mpileup_list (list) 
+        - none
     """
-    mpileup_list=[]
-    with open(args.mpileup,'r') as mpileup:
-        for line in mpileup.readlines():
-            chr, pos, ref, depth, base_call_list, qual_list = line.split("\t")
-            # check if it's a base in the bed file
-            if str(chr)+":"+str(pos) in position_list:
-                mpileup_list.append((str(chr),int(pos),int(depth)))
-    return mpileup_list
-
-def region_coverage(region_dict, mpileup_list, args):
+    coverage = int(args.coverage)
+    # the mpileup file is read as bytes so the (potentially long) base call and quality columns are never decoded.
+    # key the intervals by the encoded chromosome so the chromosome doesn't need decoding either
+    encoded_bed_intervals = {chr.encode(): intervals for chr, intervals in bed_intervals.items()}
+    with open(args.mpileup,'rb') as mpileup:
+        for line in mpileup:
+            # read the chromosome and position first, so lines for bases not in the bed file can be skipped without splitting
+            # the whole line. Most lines of a whole genome mpileup will not be in a targeted bed file.
+            chr_end = line.find(b"\t")
+            chr = line[:chr_end]
+            if chr not in encoded_bed_intervals:
+                continue
+            pos_end = line.find(b"\t", chr_end + 1)
+            pos = int(line[chr_end + 1:pos_end])
+            # check if it's a base in the bed file, by finding the last interval starting at or before the base
+            interval_starts, interval_stops, interval_offsets, covered_bases = encoded_bed_intervals[chr]
+            interval = bisect_right(interval_starts, pos) - 1
+            if interval >= 0 and pos < interval_stops[interval]:
+                # the chromosome and position have already been read, so skip the ref column and read the depth
+                # without splitting the line
+                depth_start = line.find(b"\t", pos_end + 1) + 1
+                depth = int(line[depth_start:line.find(b"\t", depth_start)])
+                base_index = interval_offsets[interval] + pos - interval_starts[interval]
+                # a low coverage record always fails the base, even if another record for the same base passes
+                if depth < coverage:
+                    covered_bases[base_index] = BASE_LOW_COVERAGE
+                elif covered_bases[base_index] == BASE_UNSEEN:
+                    covered_bases[base_index] = BASE_OK
+
+def region_coverage(regions, bed_intervals):
     """
-    This function loops through each region in the region_dict, and parses the mpileup_list, checking if the read depth at that base is
-    below the minimum required coverage (provided argument).
-    It checks that the base is present in the mpileup file, if not it will mark it as having low coverage (in case the mpileup file was 
-    not run with -a)
-    A key pair is added to the amplicon dictionary in region_dict, recording a boolean denoting if the amplicon is not completely covered
-    at the required depth (low_coverage)
-    A count for the number of amplicons completely covered above the expected value, and those not covered completelyis added to region_dict.
+    This function loops through the regions on each chromosome, and checks every base in the region has been flagged as covered at
+    the required depth in the chromosome's covered_bases (see parse_mpileup).
+    A list (low_coverage) is returned, parallel to the sequences in regions, recording a boolean denoting if the amplicon is not
+    completely covered at the required depth
+    A count for the number of amplicons completely covered above the expected value, and those not covered completely is also returned.
     Input: 
-        - command line arguments
-        - mpileup_list
-        - region_dict
+        - regions
+        - bed_intervals
+
+    Returns:
+        - low_coverage (list) 
+        - low_coverage_count (int)
+        - ok_coverage_count (int)
+    """
+    # group the index of each region by chromosome, so each chromosome's intervals are only looked up once
+    chr_regions = {}
+    for index, chr in enumerate(regions["chr"]):
+        chr_regions.setdefault(chr, []).append(index)
+    starts = regions["start"]
+    stops = regions["stop"]
+    low_coverage = [False] * len(starts)
+    for chr, indices in chr_regions.items():
+        interval_starts, interval_stops, interval_offsets, covered_bases = bed_intervals[chr]
+        chromosome_coverage(interval_starts, interval_offsets, covered_bases, starts, stops, indices, low_coverage)
+
+    # count regions with low or ok coverage
+    low_coverage_count = sum(low_coverage)
+    ok_coverage_count = len(low_coverage) - low_coverage_count
+    return low_coverage, low_coverage_count, ok_coverage_count
+
+def chromosome_coverage(interval_starts, interval_offsets, covered_bases, starts, stops, indices, low_coverage):
+    """
+    This function checks the coverage of the regions on a single chromosome. Each region only depends on the arrays for its own
+    chromosome, so chromosomes can be assessed independently of each other.
+    The low_coverage list is updated in place for each region index given.
+    Input: 
+        - interval_starts - sorted starts of the merged BED intervals for the chromosome
+        - interval_offsets - offset of each interval's first base in covered_bases
+        - covered_bases - flag for each base in the intervals, BASE_OK if the base was covered at the required depth
+        - starts, stops - BED coordinates of all regions
+        - indices - index of each region on the chromosome
+        - low_coverage - list parallel to starts and stops
 
     Returns:
-        - region_dict (dictionary) 
+        - none
     """
-    low_coverage_count = 0
-    ok_coverage_count = 0
-    for region in region_dict:
-        # set flags which can be changed to reflect an action.
-        # low coverage is used to flag the amplicon if a base is found to be below the required cutoff.
-        low_coverage = False
+    for index in indices:
         # take into account zero based, open ended BED file coordinates by adding one to start
-        for base in range(region_dict[region]["start"]+1, region_dict[region]["stop"]):
-            # set flag to check if the base is included in the mpileup file
-            seen = False
-            for mpileup_base in mpileup_list:
-                if region_dict[region]["chr"] == mpileup_base[0] and base == mpileup_base[1]:
-                    seen = True
-                    if mpileup_base[2] < int(args.coverage):
-                        low_coverage = True
-            # if the base has not been seen after parsing the mpileup we can't pass the amplicon so mark as low_coverage
-            if not seen:
-                low_coverage = True
-
-        # add the result to the dictionary        
-        region_dict[region]["low_coverage"] = low_coverage
-        
-        # add to counts of regions with low or ok coverage
-        if low_coverage:
-            low_coverage_count += 1
-        else:
-            ok_coverage_count += 1
-    
-    # check all regions have been counted
-    assert low_coverage_count+ ok_coverage_count == len(region_dict)
-    
-    # add to dictionary as a seperate field
-    region_dict["low_coverage_count"] = low_coverage_count
-    region_dict["ok_coverage_count"] = ok_coverage_count
-    return region_dict
+        first_base = starts[index] + 1
+        last_base = stops[index] - 1
+        if first_base > last_base:
+            # no bases to assess
+            continue
+        # each region lies within a single merged interval
+        interval = bisect_right(interval_starts, starts[index]) - 1
+        region_start = interval_offsets[interval] + first_base - interval_starts[interval]
+        region_end = interval_offsets[interval] + last_base - interval_starts[interval] + 1
+        # any base below the required coverage, or missing from the mpileup file, means we can't pass the amplicon.
+        # bytearray.find stops at the first matching base
+        low_coverage[index] = (covered_bases.find(BASE_LOW_COVERAGE, region_start, region_end) != -1
+                               or covered_bases.find(BASE_UNSEEN, region_start, region_end) != -1)
 
-def report_low_covered_regions(region_dict,args):
+def report_low_covered_regions(regions,low_coverage,ok_coverage_count,args):
     """
-    This function parses the region_dict and writes the coverage report. 
+    This function parses the regions and writes the coverage report. 
     Any amplicons not covered sufficiently are listed, and a count of number of passing amplicons is also stated.
     Input: 
         - command line argument
-        - region_dict
+        - regions
+        - low_coverage
+        - ok_coverage_count
 
     Returns:
         - none
     """
+    # build the report as a list of lines and write it in one go
+    report_lines = ["The listed amplicons were not completely covered at the required coverage (%sX)\n" % args.coverage]
+    for index, region_low_coverage in enumerate(low_coverage):
+        if region_low_coverage:
+            report_lines.append("%s\t%s\t%s\t%s\n" % (regions["chr"][index],regions["start"][index],regions["stop"][index],regions["description"][index]))
+    report_lines.append("The remaining %s amplicons were covered above the required coverage (%sX)\n" % (ok_coverage_count,args.coverage))
     with open(args.output_file,'w') as output_file:
-        output_file.write("The listed amplicons were not completely covered at the required coverage (%sX)\n" % args.coverage)
-        for region in region_dict:
-            # want to skip these entries in the dictionary as they don't relate to amplicons
-            if region != "low_coverage_count" and region != "ok_coverage_count":
-                if region_dict[region]["low_coverage"] == True:
-                    output_file.write("\t".join([region_dict[region]["chr"],str(region_dict[region]["start"]),str(region_dict[region]["stop"]),region_dict[region]["description"]+"\n"]))
-        output_file.write("The remaining %s amplicons were covered above the required coverage (%sX)\n" % (str(region_dict["ok_coverage_count"]),args.coverage))
-        
+        output_file.write("".join(report_lines))
+
 
 def main(args):
     # Get command line arguments
     parsed_args = cli_arguments(args)
     # read bed file to get list of amplicons/bases to calculate coverage for
-    region_dict, position_list = read_bedfile(parsed_args)
-    # extract relevant lines and columsn from mpileup file
-    mpileup_list = parse_mpileup(parsed_args,position_list)
+    regions, bed_intervals = read_bedfile(parsed_args)
+    # flag the bases in the bed file covered at the required depth in the mpileup file
+    parse_mpileup(parsed_args,bed_intervals)
     # flag any amplicons with insufficient coverage
-    region_dict = region_coverage(region_dict, mpileup_list, parsed_args)
+    low_coverage, low_coverage_count, ok_coverage_count = region_coverage(regions, bed_intervals)
     # write coevrage report
-    report_low_covered_regions(region_dict,parsed_args)
+    report_low_covered_regions(regions,low_coverage,ok_coverage_count,parsed_args)
 
 if __name__ =="__main__":
     main(sys.argv[1:])
\ No newline at end of file